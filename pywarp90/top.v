@@ -3089,6 +3089,12 @@ grid2grid(unew(0:nxnew,0:nynew):real,nxnew:integer,nynew:integer,
           uold(0:nxold,0:nyold):real,nxold:integer,nyold:integer,
           xminold:real,xmaxold:real,yminold:real,ymaxold:real) subroutine
         # project field from one grid to another using linear weighting
+grid2gridnz(unew(0:nxnew,0:nynew,nz):real,nxnew:integer,nynew:integer,nz:integer,
+            xminnew:real,xmaxnew:real,yminnew:real,ymaxnew:real,
+            uold(0:nxold,0:nyold,nz):real,nxold:integer,nyold:integer,
+            xminold:real,xmaxold:real,yminold:real,ymaxold:real) subroutine
+        # project field from one grid to another using linear weighting,
+        # for nz planes at once
 gridtogrid3d(nxin:integer,nyin:integer,nzin:integer,
              xminin:real,xmaxin:real,yminin:real,ymaxin:real,
              zminin:real,zmaxin:real,
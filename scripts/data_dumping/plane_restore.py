@@ -7,6 +7,8 @@ __all__ = ['PlaneRestore']
 
 from warp import *
 import cPickle
+import mmap
+import os
 
 class PlaneRestore:
     """
@@ -40,8 +42,9 @@ Input:
         self.verbose = verbose
 
         self.initted = False
+        self._savedphiwindows = (None,{})
 
-        self.f = open(self.filename,'rb')
+        self.openfile()
         self.readinitdata()
 
         # --- Install the routines that do the work.
@@ -67,8 +70,32 @@ Input:
         else:
             uninstalluserinjection(self.restoreparticles)
 
+    def openfile(self):
+        """Open the file, memory mapping it when possible so that the data is
+    read directly from the page cache."""
+        self._file = open(self.filename,'rb')
+        try:
+            self.f = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,EnvironmentError):
+            # --- For example, an empty file cannot be mapped
+            self.f = self._file
+
     def read(self):
-        return cPickle.load(self.f)
+        # --- Save the start of the record, since a failed load may have
+        # --- already consumed part of it.
+        position = self.f.tell()
+        try:
+            return cPickle.load(self.f)
+        except EOFError:
+            # --- The file may have been appended to since it was mapped,
+            # --- in which case it is remapped and the read tried again
+            # --- from the start of the record.
+            if (self.f is self._file or
+                os.fstat(self._file.fileno()).st_size <= len(self.f)): raise
+            self.f.close()
+            self.f = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+            self.f.seek(position)
+            return cPickle.load(self.f)
 
     def readinitdata(self):
         "Read in the initial data"
@@ -97,6 +124,10 @@ Input:
         # --- name will be 'phiplane%09d'%it
         self.data['it'] = int(name[8:])
 
+        # --- The phi plane ends each step, so it is also saved under a fixed
+        # --- name, which avoids having to generate the name from it to get it.
+        self.data['savedphi'] = val
+
         if self.verbose: print "PlaneRestore: read in data from step %d"%self.data['it']
 
     def initrestoreplane(self):
@@ -135,10 +166,23 @@ Input:
                     self.jslist= [self.js]
 
             # --- restore particle charge, mass, weight
-            for js in self.jslist:
-                top.pgroup.sq[js] = self.initdata['sq_%d'%js]
-                top.pgroup.sm[js] = self.initdata['sm_%d'%js]
-                top.pgroup.sw[js] = self.initdata['sw_%d'%js]
+            if 'jslist' in self.initdata:
+                # --- The saved arrays are in the order of the saved jslist.
+                # --- Find where each of the restored species is in it.
+                jslist = list(self.jslist)
+                jssaved = list(self.initdata['jslist'])
+                for js in jslist:
+                    assert js in jssaved,"Species %d was not saved"%js
+                ii = [jssaved.index(js) for js in jslist]
+                top.pgroup.sq[jslist] = self.initdata['sq'][ii]
+                top.pgroup.sm[jslist] = self.initdata['sm'][ii]
+                top.pgroup.sw[jslist] = self.initdata['sw'][ii]
+            else:
+                # --- Older files have the values saved separately for each species
+                for js in self.jslist:
+                    top.pgroup.sq[js] = self.initdata['sq_%d'%js]
+                    top.pgroup.sm[js] = self.initdata['sm_%d'%js]
+                    top.pgroup.sw[js] = self.initdata['sw_%d'%js]
 
             # --- make sure that pid will be allocated
             #top.npid = self.initdata['npid']
@@ -181,30 +225,18 @@ Input:
 
             # --- deal with symmetries
             # --- if saved is 2 or 4 fold symmetric and restored isn't,
-            # --- lower half of restored is filled with inverted saved phi
-            if ((self.sym_plane == 2 and (not w3d.l2symtry and not w3d.l4symtry)) or
-                (self.sym_plane == 4 and (not w3d.l2symtry and not w3d.l4symtry))):
-                self.ny0_r2 = max(0, - self.ny_plane - iya_plane + w3d.iy_axis)
-                self.nym_r2 = min(w3d.ny, 0 - iya_plane + w3d.iy_axis)
-                self.ny0_s2 = - self.ny0_r + w3d.iy_axis + iya_plane
-                self.nym_s2 =   self.nym_r - w3d.iy_axis + iya_plane
-            if ((self.sym_plane == 4 and (not w3d.l2symtry and not w3d.l4symtry)) or
-                (self.sym_plane == 4 and (    w3d.l2symtry and not w3d.l4symtry))):
-                self.nx0_r2 = max(0, - self.nx_plane - ixa_plane + w3d.ix_axis)
-                self.nxm_r2 = min(w3d.nx, 0 - ixa_plane + w3d.ix_axis)
-                self.nx0_s2 = self.nxm_r - w3d.ix_axis + ixa_plane
-                self.nxm_s2 = - self.nx0_r + w3d.ix_axis + ixa_plane
+            # --- the lower half (or quadrants) of restored is filled with
+            # --- inverted saved phi. These give the extent of those regions.
+            self.ny0_r2 = max(0, - self.ny_plane - iya_plane + w3d.iy_axis)
+            self.nym_r2 = min(w3d.ny, 0 - iya_plane + w3d.iy_axis)
+            self.nx0_r2 = max(0, - self.nx_plane - ixa_plane + w3d.ix_axis)
+            self.nxm_r2 = min(w3d.nx, 0 - ixa_plane + w3d.ix_axis)
 
         # --- Reset the time to the start time if specified.
         if self.starttime is not None:
             top.time = self.starttime
             # --- Advance time_restore until it gets to top.time.
-            # --- Use self.deltat/2. to avoid round off problems that
-            # --- could occur when comparing time_restore+deltat to top.time.
-            while self.time_restore+self.deltat/2. < top.time:
-                # --- increment the timelevel of the plane
-                self.it_restore += 1
-                self.time_restore += self.deltat
+            self.advancetotime(top.time)
             # --- Setup phi at the start time
             self.restoreplane_bfs()
 
@@ -235,23 +267,36 @@ Input:
         top.time = time
 
         # --- Advance time_restore until it gets to top.time.
-        # --- Use self.deltat/2. to avoid round off problems that
-        # --- could occur when comparing time_restore+deltat to top.time.
-        while self.time_restore+self.deltat/2. < top.time:
-            # --- increment the timelevel of the plane
-            self.it_restore += 1
-            self.time_restore += self.deltat
+        self.advancetotime(top.time)
 
         # --- restore phi only if between grid bounds
-        if (self.zplane < w3d.zmmin+top.zbeam or
-            self.zplane+top.zbeam >= w3d.zmmax): return
-
-        # --- calculate grid location of new_plane
-        iz = nint((self.zplane - top.zbeam - w3d.zmmin)/w3d.dz)
+        iz = self.getplaneiz()
+        if iz is None: return
 
         # --- load saved phi into the phi array
         self.restore_phi(iz,self.it_restore)
 
+    def advancetotime(self,time):
+        """Advances it_restore and time_restore to the time level of the
+    plane nearest to, and not before, the given time. The number of steps is
+    calculated directly rather than stepping one at a time. Using half of
+    deltat avoids round off problems that could occur when comparing
+    time_restore+deltat to the time."""
+        n = int(ceil((time - self.time_restore)/self.deltat - 0.5))
+        if n > 0:
+            self.it_restore += n
+            self.time_restore += n*self.deltat
+
+    ###########################################################################
+    def getplaneiz(self):
+        """Returns the grid location of the plane, or None if the plane is
+    outside of the grid bounds."""
+        zbeam = top.zbeam
+        zmmin = w3d.zmmin
+        if self.zplane < zmmin+zbeam or self.zplane+zbeam >= w3d.zmmax:
+            return None
+        return nint((self.zplane - zbeam - zmmin)/w3d.dz)
+
     ###########################################################################
     def restoreparticles(self):
         "Restore the particles"
@@ -300,14 +345,8 @@ Input:
             if self.verbose: print "PlaneRestore: no particle data for step",it
             return
 
-        xx = self.data['xp'+suffix]
-        yy = self.data['yp'+suffix]
-        zz = self.data['zp'+suffix] + self.zshift
-        ux = self.data['uxp'+suffix]
-        uy = self.data['uyp'+suffix]
-        uz = self.data['uzp'+suffix]
-        gi = self.data['gaminv'+suffix]
-        pid = self.data['pid'+suffix]
+        xx,yy,zz,ux,uy,uz,gi,pid = self.getparticledata(suffix)
+        zz = zz + self.zshift
 
         # --- Do some fudging to get the shape of pid correct. This is not
         # --- perfect, since it will may munge the data in pid if things
@@ -327,9 +366,8 @@ Input:
         # --- time level.
         # --- If the saved particles were synchronized and deltat == top.dt, then no advance is needed.
         # --- Note that in older data files, time was not saved, so this advance will be skipped.
-        tname = 'time%09d'%it
-        if tname in self.data:
-            oldtime = self.data[tname]
+        oldtime = self.data.get('time%09d'%it)
+        if oldtime is not None:
             if (nint(top.dt/self.dt) > 1 and (not self.lsavesynchronized or
                                               (nint(self.deltat/self.dt) == 1 and oldtime+self.dt/2. < top.time))):
                 # --- Make sure to only advance the local particles.
@@ -354,6 +392,13 @@ Input:
                      resetrho=false,
                      lnewparticles=false)
 
+    # --- Names of the particle data saved for each species and step
+    particlenames = ['xp','yp','zp','uxp','uyp','uzp','gaminv','pid']
+
+    def getparticledata(self,suffix):
+        "Returns the list of particle data arrays saved with the given suffix"
+        return [self.data[name+suffix] for name in self.particlenames]
+
     def localizeparticles(self,xx,yy,zz,ux,uy,uz,gi,pid):
         "Down select the particles, saving only particles within the local domain."
         # --- Note that this is not correct if domain decomposition is done transversely.
@@ -442,14 +487,11 @@ Input:
             self.initrestoreplane()
 
         # --- restore only if between grid bounds
-        if (self.zplane < w3d.zmmin+top.zbeam or
-            self.zplane+top.zbeam >= w3d.zmmax): return
+        iz = self.getplaneiz()
+        if iz is None: return
 
         if self.data['it'] is None: return
 
-        # --- calculate grid location of new_plane
-        iz = nint((self.zplane - top.zbeam - w3d.zmmin)/w3d.dz)
-
         # --- load saved phi into the phi array
         self.restore_phi(iz,self.it_restore)
 
@@ -459,15 +501,16 @@ Input:
         # --- this routine resets the potential at the plane iz=-1 after the
         # --- field solve if this is needed
 
+        # --- This is only needed if zplane is at iz=0, which is first checked
+        # --- with a simple comparison since it is not the case on most steps.
+        if abs(self.zplane - top.zbeam - w3d.zmmin) > 0.5*w3d.dz: return
+
         # --- restore only if between grid bounds
-        if (self.zplane < w3d.zmmin+top.zbeam or
-            self.zplane+top.zbeam >= w3d.zmmax): return
+        iz = self.getplaneiz()
+        if iz is None: return
 
         if self.data['it'] is None: return
 
-        # --- calculate grid location of new_plane
-        iz = nint((self.zplane - top.zbeam - w3d.zmmin)/w3d.dz)
-
         # --- reset phi at plane iz=-1 if zplane is at iz=0
         if (iz == 0):
             self.restore_phi(iz,self.it_restore)
@@ -485,10 +528,7 @@ Input:
         if self.data['it'] > it: return
 
         # --- Read in the phi data if it is available.
-        if 'phiplane%09d'%it not in self.data: return
-
-        savedphi = self.data['phiplane%09d'%it]
-
+        savedphi = self.data['savedphi']
         if savedphi is None: return
 
         solver = getregisteredsolver()
@@ -516,49 +556,93 @@ Input:
     # Both saved and restored phi are 3-D.
     def restore_phi_3d_to_3d(self,iz,it,savedphi,phi,solver):
         if iz < 0 or iz > solver.nzlocal: return
-        for i in range(2):
-            grid2grid(phi[self.nx0_r:self.nxm_r+1,self.ny0_r:self.nym_r+1,iz+i],
-                      solver.nx,solver.ny,
-                      solver.xmmin,solver.xmmax,solver.ymmin,solver.ymmax,
-                      savedphi[...,i],self.nx_plane,self.ny_plane,
-                      self.xmmin,self.xmmax,self.ymmin,self.ymmax)
-
-        if ((self.sym_plane == 2 and (not solver.l2symtry and not solver.l4symtry)) or
-            (self.sym_plane == 4 and (not solver.l2symtry and not solver.l4symtry))):
-        #     phi(self.nx0_r:self.nxm_r,self.ny0_r2:self.nym_r2,iz-1:iz)=
-        #      phi_plane(nx0_s:nxm_s,nym_s2:ny0_s2:-1,)
-            for i in range(2):
-                grid2grid(phi[self.nx0_r:self.nxm_r,self.ny0_r2:self.nym_r2,iz+i],
-                          solver.nx,solver.ny,
-                          solver.xmmin,solver.xmmax,solver.ymmin,solver.ymmax,
-                          savedphi[...,i],self.nx_plane,self.ny_plane,
-                          self.xmmin,self.xmmax,self.ymmin,self.ymmax)
-
-        if ((self.sym_plane == 4 and ( solver.l2symtry and not solver.l4symtry))):
-        #  phi(nx0_r2:nxm_r2,ny0_r:nym_r,iz-1:iz)=
-        #    phi_plane(nx0_s2:nxm_s2:-1,ny0_s:nym_s,)
-            for i in range(2):
-                grid2grid(phi[self.nx0_r:self.nxm_r,self.ny0_r2:self.nym_r2,iz+i],
-                          solver.nx,solver.ny,
-                          solver.xmmin,solver.xmmax,solver.ymmin,solver.ymmax,
-                          savedphi[...,i],self.nx_plane,self.ny_plane,
-                          self.xmmin,self.xmmax,self.ymmin,self.ymmax)
-
-        if ((self.sym_plane == 4 and (not solver.l2symtry and not solver.l4symtry))):
-        #  phi(nx0_r2:nxm_r2,ny0_r2:nym_r,iz-1:iz)=
-        #    phi_plane(nx0_s2:nxm_s2:-1,ny0_s2:nym_s,)
-            for i in range(2):
-                grid2grid(phi[self.nx0_r:self.nxm_r,self.ny0_r2:self.nym_r2,iz+i],
-                          solver.nx,solver.ny,
-                          solver.xmmin,solver.xmmax,solver.ymmin,solver.ymmax,
-                          savedphi[...,i],self.nx_plane,self.ny_plane,
-                          self.xmmin,self.xmmax,self.ymmin,self.ymmax)
+
+        # --- The table of regions only depends on the grids and symmetries
+        # --- so it is built once, on the first call.
+        try:
+            regions = self._3d_to_3d_regions
+        except AttributeError:
+            regions = self._3d_to_3d_regions = self.get3dto3dregions(solver)
+
+        # --- The windows of the saved phi are copied into contiguous arrays
+        # --- once per step, and reused when phi is restored again on the
+        # --- same step, i.e. after the field solve or for phip.
+        itwindows,windows = self._savedphiwindows
+        if itwindows != it:
+            windows = {}
+            self._savedphiwindows = (it,windows)
+
+        # --- Each region is filled with a single projection, which does both
+        # --- planes, iz and iz+1, at once.
+        for ir,(ix0,ixm,iy0,iym,xmin,xmax,ymin,ymax,
+                xs,ys,jx0,jxm,jy0,jym,sxmin,sxmax,symin,symax) in enumerate(regions):
+            window = windows.get(ir)
+            if window is None:
+                window = asfortranarray(savedphi[::xs,::ys,0:2][jx0:jxm+1,jy0:jym+1,:])
+                windows[ir] = window
+            grid2gridnz(phi[ix0:ixm+1,iy0:iym+1,iz:iz+2],
+                        ixm-ix0,iym-iy0,2,xmin,xmax,ymin,ymax,
+                        window,jxm-jx0,jym-jy0,sxmin,sxmax,symin,symax)
+
+    def get3dto3dregions(self,solver):
+        """Returns the list of regions of the restored phi that are filled from
+    the saved phi. Each entry holds the grid cell range of the region and its
+    extent, the direction that the saved phi is read in (-1 when mirrored),
+    and the range of cells of the saved phi covering the region and its extent.
+    If the saved phi has a symmetry that the restored phi does not, the rest of
+    the restored phi is filled in using the mirrored saved phi, which is the
+    saved phi reversed along the mirrored axis with its extent negated."""
+        xmirror = [False]
+        ymirror = [False]
+        if self.sym_plane == 4 and not solver.l4symtry:
+            xmirror.append(True)
+        if self.sym_plane in [2,4] and not solver.l2symtry and not solver.l4symtry:
+            ymirror.append(True)
+
+        dx = (solver.xmmax - solver.xmmin)/solver.nx
+        dy = (solver.ymmax - solver.ymmin)/solver.ny
+        regions = []
+        for lxmirror in xmirror:
+            if lxmirror:
+                ix0,ixm = self.nx0_r2,self.nxm_r2
+                xs,sxmin,sxmax = -1,-self.xmmax,-self.xmmin
+            else:
+                ix0,ixm = self.nx0_r,self.nxm_r
+                xs,sxmin,sxmax = +1,self.xmmin,self.xmmax
+            for lymirror in ymirror:
+                if lymirror:
+                    iy0,iym = self.ny0_r2,self.nym_r2
+                    ys,symin,symax = -1,-self.ymmax,-self.ymmin
+                else:
+                    iy0,iym = self.ny0_r,self.nym_r
+                    ys,symin,symax = +1,self.ymmin,self.ymmax
+                # --- Skip regions that have no extent
+                if ixm <= ix0 or iym <= iy0: continue
+                xmin,xmax = solver.xmmin+ix0*dx,solver.xmmin+ixm*dx
+                ymin,ymax = solver.ymmin+iy0*dy,solver.ymmin+iym*dy
+                # --- Only the window of the saved phi that overlaps the
+                # --- region is passed in, so that only that part is read.
+                jx0,jxm,wxmin,wxmax = self.getsavedwindow(xmin,xmax,sxmin,sxmax,
+                                                          self.nx_plane)
+                jy0,jym,wymin,wymax = self.getsavedwindow(ymin,ymax,symin,symax,
+                                                          self.ny_plane)
+                regions.append((ix0,ixm,iy0,iym,xmin,xmax,ymin,ymax,
+                                xs,ys,jx0,jxm,jy0,jym,wxmin,wxmax,wymin,wymax))
+        return regions
+
+    def getsavedwindow(self,xmin,xmax,sxmin,sxmax,nx):
+        """Returns the range of cells of the saved grid, with nx cells from sxmin
+    to sxmax, that covers xmin to xmax, and the extent of that range."""
+        dxs = (sxmax - sxmin)/nx
+        j0 = min(nx-1,max(0,int(floor((xmin - sxmin)/dxs))))
+        jm = max(j0+1,min(nx,int(ceil((xmax - sxmin)/dxs))))
+        return j0,jm,sxmin+j0*dxs,sxmin+jm*dxs
 
     def restore_phi_rz_to_rz(self,iz,it,savedphi,phi,solver):
         if iz < 0 or iz > solver.nzlocal: return
         # --- For now, this assumes that the arrays are the same shape.
-        phi[1:-1,0,iz] = savedphi[:,0]
-        phi[1:-1,0,iz+1] = savedphi[:,1]
+        # --- Both planes, iz and iz+1, are copied at once.
+        phi[1:-1,0,iz:iz+2] = savedphi[:,0:2]
 
     #######################################################################
     # This routine copies the saved phi plane into the current phi array
@@ -575,18 +659,28 @@ Input:
             ymmin = w3d.ymmin + w3d.dy*self.ny0_r
             ny = self.nym_r - self.ny0_r
             xmesh,ymesh = getmesh2d(xmmin,w3d.dx,nx,ymmin,w3d.dy,ny)
-            rmesh = sqrt(xmesh**2 + ymesh**2)
             dr = (self.xmmax - self.xmmin)/self.nx_plane
-            self.irmesh = aint(rmesh/dr)
-            self.wrmesh =     rmesh/dr  - self.irmesh
-            self.wrmesh = where(self.irmesh >= self.nx_plane,1,self.wrmesh)
-            self.irmesh = where(self.irmesh >= self.nx_plane,self.nx_plane-1,self.irmesh)
+            rmesh = sqrt(xmesh**2 + ymesh**2)/dr
+            # --- Save integer indices and the weights with the same type as
+            # --- phi so that both planes can be interpolated at once below.
+            self.irmesh = rmesh.astype(int32)
+            self.wrmesh = (rmesh - self.irmesh).astype(phi.dtype)
+            # --- Points outside of the saved grid get the value at its edge.
+            oob = (self.irmesh >= self.nx_plane)
+            clip(self.irmesh,0,self.nx_plane-1,out=self.irmesh)
+            self.wrmesh[oob] = 1.
+            self.irmesh1 = self.irmesh + 1
+            self.wrmesh_m = 1. - self.wrmesh
 
         i1 = self.nx0_r
         i2 = self.nxm_r+1
         j1 = self.ny0_r
         j2 = self.nym_r+1
-        for i in range(2):
-            phi[i1:i2,j1:j2,iz+i] = (
-                take(savedphi[:,0,i],self.irmesh  )*(1.-self.wrmesh) +
-                take(savedphi[:,0,i],self.irmesh+1)*self.wrmesh)
+        # --- The take returns arrays of shape (nx+1,ny+1,2), holding the
+        # --- values at iz and iz+1. The results are written directly into
+        # --- phi, avoiding the temporary of the sum.
+        sp = savedphi[:,0,:]
+        phiview = phi[i1:i2,j1:j2,iz:iz+2]
+        multiply(sp.take(self.irmesh,axis=0),self.wrmesh_m[...,newaxis],
+                 out=phiview)
+        phiview += sp.take(self.irmesh1,axis=0)*self.wrmesh[...,newaxis]
@@ -166,7 +166,16 @@ Input:
 
         if self.lsaveparticles:
             self.write('npid',top.npid)
-            # --- Write out particle quantities for each species
+            # --- Write out particle quantities of the saved species, each as a
+            # --- single array in the order of jslist, which is written with
+            # --- them so that the restore can map the species explicitly.
+            jslist = list(self.jslist)
+            self.write('jslist',array(jslist))
+            self.write('sq',top.pgroup.sq[jslist])
+            self.write('sm',top.pgroup.sm[jslist])
+            self.write('sw',top.pgroup.sw[jslist])
+            # --- The quantities are also written for each species so that
+            # --- the files can still be read by older versions of PlaneRestore.
             for js in self.jslist:
                 self.write('sq_%d'%js,top.pgroup.sq[js])
                 self.write('sm_%d'%js,top.pgroup.sm[js])
@@ -702,18 +702,18 @@ class GPSTD(Fourier_Space):
 
             # --- update diagonal first
             # --- if matrix value is 1., do nothing
-            if not mymat[i][i] is 1.:
+            if not iszero(mymat[i][i]-1.):
                 updated_fields[ki] = True
-                if mymat[i][i] is 0.:
+                if iszero(mymat[i][i]):
                 # --- if matrix value is 0., zero out array
-                    self.Ffields[i][...] = 0.
+                    self.Ffields[ki][...] = 0.
                 else:
                 # --- otherwise, multiply by matrix value
                     self.Ffields[ki] *= mymat[i][i]
 
             # --- update field for non-diagonal matrix elements.
             for j in range(n):
-                if i!=j and not mymat[i][j] is 0.:
+                if i!=j and not iszero(mymat[i][j]):
                     # --- update only if matrix element is non-zero
                     updated_fields[ki] = True
                     kj = self.fields_name[j]
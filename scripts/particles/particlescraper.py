@@ -154,6 +154,8 @@ class ParticleScraper(object):
             if self.lrefineintercept or self.lrefineallintercept:
                 self.lsaveoldvelocities = true
         self.l_print_timing=0
+        # --- Scratch arrays that are reused in the scraping routines
+        self._scratch = {}
         # --- If the user specified the grid, then add the conductors
         if self.usergrid:
             # --- Make sure that the grid has some finite extent. If not, then just
@@ -205,6 +207,14 @@ class ParticleScraper(object):
             if isinstalledparticlescraper(self.scrapeall):
                 uninstallparticlescraper(self.scrapeall)
 
+    def __getstate__(self):
+        """This is called when the instance is pickled."""
+        dict = self.__dict__.copy()
+        # --- The scratch arrays are not saved since they are only temporary
+        # --- work space. They are recreated in __setstate__.
+        if '_scratch' in dict: del dict['_scratch']
+        return dict
+
     def __setstate__(self,dict):
         """This is called when the instance is unpickled."""
         self.__dict__.update(dict)
@@ -223,6 +233,8 @@ class ParticleScraper(object):
         if 'lrefineallintercept' not in self.__dict__:
             self.lrefineallintercept = 0
 
+        if '_scratch' not in self.__dict__:
+            self._scratch = {}
         if 'lfastscraper' not in self.__dict__:
             self.lfastscraper = 0
         if 'reflectiveconductors' not in self.__dict__:
@@ -429,16 +441,37 @@ class ParticleScraper(object):
                     top.pgroup.pid[i1:i2,self.uyoldpid] = top.pgroup.uyp[i1:i2]
                     top.pgroup.pid[i1:i2,self.uzoldpid] = top.pgroup.uzp[i1:i2]
 
-    def applysymmetry(self,xc,yc):
+    def _scratchbuffer(self,name,n,dtype='d'):
+        """Returns a scratch array of length n. The arrays are saved and reused,
+    avoiding a new allocation on every call. Note that the contents are not
+    initialized, and that the array is overwritten by the next call with the
+    same name.
+        """
+        b = self._scratch.get(name)
+        if b is None or b.size < n or b.dtype != dtype:
+            b = zeros(n,dtype)
+            self._scratch[name] = b
+        return b[:n]
+
+    def applysymmetry(self,xc,yc,out=None):
         """Apply symmetry conditions to the positions so that the data passed
     into isinside is consistent with that obtained from the grid.
+    out: optional pair of arrays where the results are written when the
+         symmetry changes the positions, avoiding new allocations.
         """
         if self.grid.l4symtry:
-            xcsym = abs(xc)
-            ycsym = abs(yc)
+            if out is None:
+                xcsym = abs(xc)
+                ycsym = abs(yc)
+            else:
+                xcsym = absolute(xc,out=out[0])
+                ycsym = absolute(yc,out=out[1])
         elif self.grid.l2symtry:
             xcsym = xc
-            ycsym = abs(yc)
+            if out is None:
+                ycsym = abs(yc)
+            else:
+                ycsym = absolute(yc,out=out[1])
         else:
             xcsym = xc
             ycsym = yc
@@ -516,6 +549,12 @@ class ParticleScraper(object):
         if nz > 0: iza = nint(-zmin/dz)
         isinside = self.grid.isinside
 
+        # --- Get the species parameters into local variables since they are
+        # --- used repeatedly in the loops below.
+        q = top.pgroup.sq[js]
+        m = top.pgroup.sm[js]
+        dtjs = top.dt*top.pgroup.ndts[js]*top.pgroup.dtscale[js]
+
         # --- Get handy references to the particles in the species
         i1 = top.pgroup.ins[js] - 1
         i2 = top.pgroup.ins[js] + top.pgroup.nps[js] - 1
@@ -717,7 +756,7 @@ class ParticleScraper(object):
 
                     # --- Get the largest distance that the particles could travel
                     # --- in one time step.
-                    qom = top.pgroup.sq[js]/top.pgroup.sm[js]
+                    qom = q/m
                     xchange = abs(uxo*top.dt) + abs(0.5*qom*ex*top.dt**2)
                     ychange = abs(uyo*top.dt) + abs(0.5*qom*ey*top.dt**2)
                     zchange = abs(uzo*top.dt) + abs(0.5*qom*ez*top.dt**2)
@@ -757,9 +796,8 @@ class ParticleScraper(object):
 
                     # --- Create some temporaries
                     itime = None
-                    dt = top.dt*top.pgroup.ndts[js]*top.pgroup.dtscale[js]*ones(len(ii))
-                    q = top.pgroup.sq[js]
-                    m = top.pgroup.sm[js]
+                    dt = self._scratchbuffer('dt',len(ii))
+                    dt.fill(dtjs)
 
                     # --- Do the refinement calculation. The currentisinside argument sets
                     # --- when the current position is replaced by the refined position.
@@ -880,20 +918,16 @@ class ParticleScraper(object):
     counting the current lost on the conductor.
         """
         jsid = top.pgroup.sid[js]
+        q = top.pgroup.sq[js]
+        m = top.pgroup.sm[js]
+        dtjs = top.dt*top.pgroup.ndts[js]*top.pgroup.dtscale[js]
 
         # --- Just return if there are no lost particles.
         if top.npslost[jsid] == 0:
             if self.lcollectlpdata and not local:
                 # --- If data is being collected, the 0 from this processor must still
                 # --- be added to the sum.
-                for c in self.conductors:
-                    # --- This parallelsum coordinates with the ones below.
-                    w=parallelsum(0.)
-                    if w != 0.:
-                        c.lostparticles_data.append(array([top.time,
-                                                           w*top.pgroup.sq[js]*top.pgroup.sw[js],
-                                                           top.dt,
-                                                           jsid]))
+                self.savelostparticlesdata(js,[(c,0.,1) for c in self.conductors],local)
             return
 
         # --- First make sure there is extra space in the pidlost array.
@@ -982,18 +1016,16 @@ class ParticleScraper(object):
             x8 = take(xx,iscrape-i1)
             y8 = take(yy,iscrape-i1)
 
+        # --- The weights lost on each conductor are accumulated in lpdata
+        # --- and saved after the loop, so that only one parallelsum is needed.
+        lpdata = []
+
         # --- Loop over the conductors, removing particles inside of each.
         for c in self.conductors:
             ii = compress(pp == c.condid,arange(nn))
             if len(ii) == 0:
-                if self.lcollectlpdata and not local:
-                    # --- This parallelsum coordinates with the other processors
-                    w=parallelsum(0.)
-                    if w != 0.:
-                        c.lostparticles_data.append(array([top.time,
-                                                           w*top.pgroup.sq[js]*top.pgroup.sw[js],
-                                                           top.dt,
-                                                           jsid]))
+                if self.lcollectlpdata:
+                    lpdata.append((c,0.,1))
                 continue
             xc = take(x8,ii)
             yc = take(y8,ii)
@@ -1003,55 +1035,58 @@ class ParticleScraper(object):
             ic = take(iscrape,ii)
             ic = compress(c.isinside(xcsym,ycsym,zc).isinside,ic)
             if len(ic) == 0:
-                if self.lcollectlpdata and not local:
-                    # --- This parallelsum coordinates with the other processors
-                    w=parallelsum(0.)
-                    if w != 0.:
-                        c.lostparticles_data.append(array([top.time,
-                                                           w*top.pgroup.sq[js]*top.pgroup.sw[js],
-                                                           top.dt,
-                                                           jsid]))
+                if self.lcollectlpdata:
+                    lpdata.append((c,0.,1))
                 continue
             # --- For particles which are inside, set pid to the id of the conductor
             # --- where the particle is lost.
-            put(top.pidlost[:,-1],ic,c.condid)
+            top.pidlost[ic,-1] = c.condid
             # --- Save location and surface normal where particle intercepted the
             # --- conductor.
             if self.lsaveintercept:
 
                 # --- Don't calculate the intercept for new particles, for which there
                 # --- is no old data saved.
-                oldisOK = nint(take(top.pidlost[:,self.oldisOK],ic))
+                oldisOK = nint(top.pidlost[ic,self.oldisOK])
                 icnew = compress(logical_not(oldisOK),ic)
                 if len(icnew) > 0:
                     # --- Set the conductor ID to zero, so that these particles are
                     # --- ignored.
-                    put(top.pidlost[:,-1],icnew,0)
+                    top.pidlost[icnew,-1] = 0
                     # --- Downselect to only include the older particles.
                     ic = compress(oldisOK,ic)
 
+            # --- Skip the intercept calculation if there are no particles left,
+            # --- for example when all of the lost particles are new.
+            if self.lsaveintercept and len(ic) > 0:
+
                 xc = take(xx,ic-i1)
                 yc = take(yy,ic-i1)
                 zc = take(zz,ic-i1)
-                xo = take(top.pidlost[:,self.xoldpid],ic)
-                yo = take(top.pidlost[:,self.yoldpid],ic)
-                zo = take(top.pidlost[:,self.zoldpid],ic)
+                # --- Gather the rows of the lost particles first and then the
+                # --- columns, so that only len(ic) values are copied for each
+                # --- of the old quantities rather than the whole columns.
+                # --- The result is made contiguous since the arrays are
+                # --- modified in place by refineintercept.
+                oldpids = [self.xoldpid,self.yoldpid,self.zoldpid]
+                if self.lrefineintercept:
+                    oldpids += [self.uxoldpid,self.uyoldpid,self.uzoldpid]
+                olddata = ascontiguousarray(top.pidlost.take(ic,axis=0).take(oldpids,axis=1).T)
+                xo,yo,zo = olddata[:3]
 
-                dt = top.dt*top.pgroup.ndts[js]*top.pgroup.dtscale[js]
+                dt = dtjs
                 if self.lrefineintercept:
-                    uxo = take(top.pidlost[:,self.uxoldpid],ic)
-                    uyo = take(top.pidlost[:,self.uyoldpid],ic)
-                    uzo = take(top.pidlost[:,self.uzoldpid],ic)
-                    ex = take(top.exlost,ic)
-                    ey = take(top.eylost,ic)
-                    ez = take(top.ezlost,ic)
-                    bx = take(top.bxlost,ic)
-                    by = take(top.bylost,ic)
-                    bz = take(top.bzlost,ic)
-                    itime = zeros(len(ic),'d')
-                    dt *= ones(len(ic))
-                    q = top.pgroup.sq[js]
-                    m = top.pgroup.sm[js]
+                    uxo,uyo,uzo = olddata[3:]
+                    ex = top.exlost[ic]
+                    ey = top.eylost[ic]
+                    ez = top.ezlost[ic]
+                    bx = top.bxlost[ic]
+                    by = top.bylost[ic]
+                    bz = top.bzlost[ic]
+                    itime = self._scratchbuffer('itime',len(ic))
+                    itime.fill(0.)
+                    dt = self._scratchbuffer('dt',len(ic))
+                    dt.fill(dtjs)
                     self.refineintercept(c,xc,yc,zc,xo,yo,zo,uxo,uyo,uzo,
                                          ex,ey,ez,bx,by,bz,itime,dt,q,m,0,
                                          zeros(len(xc),'l'))
@@ -1063,11 +1098,9 @@ class ParticleScraper(object):
                     # --- just outside and inside of the conductor, differing by the
                     # --- refined time step size. That refined step size is needed
                     # --- to get the correct approximation to the velocity.
-                    bx = take(top.bxlost,ic)
-                    by = take(top.bylost,ic)
-                    bz = take(top.bzlost,ic)
-                    q = top.pgroup.sq[js]
-                    m = top.pgroup.sm[js]
+                    bx = top.bxlost[ic]
+                    by = top.bylost[ic]
+                    bz = top.bzlost[ic]
                     dt = dt/self.getrefinedtimestepnumber(dt,bx,by,bz,q,m)
 
                 # --- use an approximate calculation.
@@ -1076,9 +1109,9 @@ class ParticleScraper(object):
                     vy = (yc-yo)/dt
                     vz = (zc-zo)/dt
                 elif self.interceptvelocitymethod == 'actualvelocity':
-                    ux = take(top.uxplost,ic)
-                    uy = take(top.uyplost,ic)
-                    uz = take(top.uzplost,ic)
+                    ux = top.uxplost[ic]
+                    uy = top.uyplost[ic]
+                    uz = top.uzplost[ic]
                     gi = 1./sqrt(1.+(ux**2+uy**2+uz**2)/clight**2)
                     vx = ux*gi
                     vy = uy*gi
@@ -1095,59 +1128,90 @@ class ParticleScraper(object):
                     vz = (vz-boost_beta*clight)*fact
 
                 intercept = c.intercept(xc,yc,zc,vx,vy,vz)
-                dtintercept = (sqrt((xc - intercept.xi)**2 +
-                                    (yc - intercept.yi)**2 +
-                                    (zc - intercept.zi)**2)/
-                      dvnz(sqrt(vx**2 + vy**2 + vz**2))) + itime
-
-                put(top.xplost,ic,intercept.xi)
-                put(top.yplost,ic,intercept.yi)
-                put(top.zplost,ic,intercept.zi)
+                vmag = sqrt(vx**2 + vy**2 + vz**2)
+                # --- The divide is done in place. As with dvnz, where vmag
+                # --- is zero, the distance is divided by smallpos instead.
+                dtintercept = sqrt((xc - intercept.xi)**2 +
+                                   (yc - intercept.yi)**2 +
+                                   (zc - intercept.zi)**2)
+                vmagiszero = (vmag == 0.)
+                divide(dtintercept,vmag,out=dtintercept,where=logical_not(vmagiszero))
+                if vmagiszero.any(): dtintercept[vmagiszero] /= top.smallpos
+                dtintercept += itime
+
+                top.xplost[ic] = intercept.xi
+                top.yplost[ic] = intercept.yi
+                top.zplost[ic] = intercept.zi
 
                 # --- Also, reset the velocities
                 if top.lrelativ:
-                    beta = sqrt(vx**2 + vy**2 + vz**2)/clight
+                    beta = vmag/clight
                     # --- If beta is too large, then reset the velocities. Note that
                     # --- there may be some other but that is making beta too large.
                     # --- It looks like in some cases, the x and xold etc positions are
                     # --- inconsistent and very far from each each, giving an errorneous
                     # --- value of vx etc.
-                    # --- betacorrection is written this way to avoid dividing by zero
+                    # --- The scale factor clamps beta to 0.99999 without branching.
+                    # --- It is written this way to avoid dividing by zero
                     # --- when beta == 0.
-                    betacorrection = 1./where(beta >= 0.99999,beta/0.99999,1.)
-                    beta = minimum(beta,0.99999)
+                    scale = minimum(1.,0.99999/maximum(beta,top.smallpos))
+                    multiply(vx,scale,out=vx)
+                    multiply(vy,scale,out=vy)
+                    multiply(vz,scale,out=vz)
+                    beta *= scale
                     gamma = 1./sqrt((1.-beta)*(1.+beta))
-                    ux = vx*(gamma*betacorrection)
-                    uy = vy*(gamma*betacorrection)
-                    uz = vz*(gamma*betacorrection)
+                    ux = vx*gamma
+                    uy = vy*gamma
+                    uz = vz*gamma
                 else:
                     gamma = 1.
                     ux = vx
                     uy = vy
                     uz = vz
-                put(top.uxplost,ic,ux)
-                put(top.uyplost,ic,uy)
-                put(top.uzplost,ic,uz)
-                put(top.gaminvlost,ic,1./gamma)
+                top.uxplost[ic] = ux
+                top.uyplost[ic] = uy
+                top.uzplost[ic] = uz
+                top.gaminvlost[ic] = 1./gamma
 
                 # --- Set the angle of incidence and time of interception
-                put(top.pidlost[:,-3],ic,intercept.itheta)
-                put(top.pidlost[:,-2],ic,intercept.iphi)
-                put(top.pidlost[:,-4],ic,top.time - dtintercept)
+                # --- Since pidlost is Fortran ordered, each column is
+                # --- contiguous, so the columns are scattered separately.
+                top.pidlost[ic,-3] = intercept.itheta
+                top.pidlost[ic,-2] = intercept.iphi
+                top.pidlost[ic,-4] = top.time - dtintercept
 
             if self.lcollectlpdata:
-                pidlostcondid = take(top.pidlost[:,-1],iscrape1)
+                pidlostcondid = top.pidlost[iscrape1,-1]
                 pidtoconsider = compress(pidlostcondid==c.condid,iscrape1)
                 if top.wpid==0:
                     w = len(pidtoconsider)
                 else:
-                    w = sum(take(top.pidlost[:,top.wpid-1],pidtoconsider))
-                # --- This parallelsum coordinates with the ones above
-                if not local:w=parallelsum(w)
-                c.lostparticles_data.append(array([top.time,
-                                                   w*top.pgroup.sq[js]*top.pgroup.sw[js],
-                                                   top.dt,
-                                                   jsid]))
+                    w = sum(top.pidlost[pidtoconsider,top.wpid-1])
+                lpdata.append((c,w,0))
+
+        if self.lcollectlpdata:
+            self.savelostparticlesdata(js,lpdata,local)
+
+    def savelostparticlesdata(self,js,lpdata,local=0):
+        """Appends the lost particle data for species js to the lostparticles_data
+    of each conductor. lpdata is a list of tuples, (c,w,lskipzero), where c is
+    the conductor, w is the weight of particles lost on it on this processor,
+    and when lskipzero is true, nothing is appended when the total weight is
+    zero. Unless local is true, the weights are summed over the processors with
+    a single parallelsum. Note that all processors must call this with the same
+    conductors.
+        """
+        if len(lpdata) == 0: return
+        jsid = top.pgroup.sid[js]
+        qw = top.pgroup.sq[js]*top.pgroup.sw[js]
+        ww = array([w for c,w,lskipzero in lpdata],'d')
+        if not local: ww = parallelsum(ww)
+        for (c,w,lskipzero),wsum in zip(lpdata,ww):
+            if lskipzero and wsum == 0.: continue
+            c.lostparticles_data.append(array([top.time,
+                                               wsum*qw,
+                                               top.dt,
+                                               jsid]))
 
 
     def getrefinedtimestepnumber(self,dt,bx,by,bz,q,m):
@@ -1223,15 +1287,25 @@ class ParticleScraper(object):
 
         # --- Save the positions. This is needed so that the data can be
         # --- restored if no intercept is found below.
-        xcsave = xc.copy()
-        ycsave = yc.copy()
-        zcsave = zc.copy()
-        xosave = xo.copy()
-        yosave = yo.copy()
-        zosave = zo.copy()
-        uxosave = uxo.copy()
-        uyosave = uyo.copy()
-        uzosave = uzo.copy()
+        # --- Scratch arrays are used to avoid allocating new arrays each time.
+        xcsave = self._scratchbuffer('xcsave',nn)
+        ycsave = self._scratchbuffer('ycsave',nn)
+        zcsave = self._scratchbuffer('zcsave',nn)
+        xosave = self._scratchbuffer('xosave',nn)
+        yosave = self._scratchbuffer('yosave',nn)
+        zosave = self._scratchbuffer('zosave',nn)
+        uxosave = self._scratchbuffer('uxosave',nn)
+        uyosave = self._scratchbuffer('uyosave',nn)
+        uzosave = self._scratchbuffer('uzosave',nn)
+        xcsave[:] = xc
+        ycsave[:] = yc
+        zcsave[:] = zc
+        xosave[:] = xo
+        yosave[:] = yo
+        zosave[:] = zo
+        uxosave[:] = uxo
+        uyosave[:] = uyo
+        uzosave[:] = uzo
 
         # --- Get the starting positions of the advance. These should all be
         # --- outside of the conductor. The loop below advances the particles
@@ -1248,6 +1322,9 @@ class ParticleScraper(object):
         # --- don't change anymore.
         # --- One possible optimization is to have the fortran advancing
         # --- routines skip particles that have a zero time step size.
+        zmmin = w3d.zmmin + top.zbeam
+        zmmax = w3d.zmmax + top.zbeam
+        symbuffer = (self._scratchbuffer('xcsym',nn),self._scratchbuffer('ycsym',nn))
         for it in range(nsteps):
 
             # --- Do a full split leap-frog advance (with constant E and B fields)
@@ -1266,15 +1343,13 @@ class ParticleScraper(object):
             #pldj(xo,yo,xc,yc,color=green)
 
             # --- Check whether the new positions are inside of the conductor.
-            xcsym,ycsym = self.applysymmetry(xc,yc)
+            xcsym,ycsym = self.applysymmetry(xc,yc,out=symbuffer)
             isinside[:] = c.isinside(xcsym,ycsym,zc).isinside
 
             # --- Kludgy code to handle some boundary conditions
             # --- This code is OK in serial, but in parallel, it will break with
             # --- periodic b.c.s and if a particle crosses a parallel domain
             # --- boundary.
-            zmmin = w3d.zmmin + top.zbeam
-            zmmax = w3d.zmmax + top.zbeam
             if top.pboundxy == periodic:
                 xc[:] = where(xc > w3d.xmmax,xc-(w3d.xmmax-w3d.xmmin),xc)
                 xc[:] = where(xc < w3d.xmmin,xc+(w3d.xmmax-w3d.xmmin),xc)
@@ -279,14 +279,25 @@ def childlangmuir(v,d,q=None,m=None):
 def dvnz(x):
     """
   Used to protect is divides and square roots. Returns the argument, except when
-  it is zero, then returns smallpos.
+  it is zero, then returns smallpos. Arrays are always returned as float. Note
+  that when a float array has no zeros, the argument itself is returned, so the
+  result should not be modified in place.
     """
+    # --- The python copy of smallpos is used, avoiding the lookup in top
+    # --- on every call.
     if len(shape(x)) == 0:
-        if x == 0.: return top.smallpos
+        if x == 0.: return smallpos
         else:       return x
     else:
-        return where(x==0.,top.smallpos,x)
-    #return sign(abs(x)+top.smallpos,x)
+        # --- In the common case where there are no zeros, x is returned as
+        # --- is, avoiding making a new array. It is converted to float
+        # --- first so that the type of the result does not depend on whether
+        # --- x has any zeros.
+        x = asarray(x,dtype=float)
+        iszero = (x == 0.)
+        if not iszero.any(): return x
+        return where(iszero,smallpos,x)
+    #return sign(abs(x)+smallpos,x)
 
 #=============================================================================
 # --- Setup and make initial printout of the versions of the packages.
@@ -409,11 +420,19 @@ def rnormarray(x,i1=None,nbase1=None,nbase2=None):
         try:
             return random.standard_normal(shape(x))
         except:
-            # --- Use pseudo-random number generator
-            s = random.random(shape(x))
-            phi = 2.*pi*random.random(shape(x))
-            sq = sqrt(-2.*log(s))
-            return sq*cos(phi)
+            # --- Use pseudo-random number generator, with the Box-Muller
+            # --- transform done in place on a single array of uniform deviates
+            # --- The ellipses ensure that s and phi are writable views even
+            # --- when x is a scalar.
+            u = random.random((2,) + shape(x))
+            s,phi = u[0,...],u[1,...]
+            log(s,out=s)
+            s *= -2.
+            sqrt(s,out=s)
+            phi *= 2.*pi
+            cos(phi,out=phi)
+            s *= phi
+            return s
     else:
         # --- Use digit reversed random number generator
         if not nbase1: nbase1 = 2
@@ -517,22 +536,17 @@ def getappliedfieldsongrid(nx=None,ny=None,nz=None,
         zmin = 0.
         zmax = 0.
 
-    x,y,z = getmesh3d(xmin,dx,nx,ymin,dy,ny,zmin,dz,nz)
-    nxyz = product(array(shape(x)))
-    x.shape = (nxyz,)
-    y.shape = (nxyz,)
-    z.shape = (nxyz,)
-    ex,ey,ez,bx,by,bz = getappliedfields(x,y,z)
-    ex.shape = (1+nx,1+ny,1+nz)
-    ey.shape = (1+nx,1+ny,1+nz)
-    ez.shape = (1+nx,1+ny,1+nz)
-    bx.shape = (1+nx,1+ny,1+nz)
-    by.shape = (1+nx,1+ny,1+nz)
-    bz.shape = (1+nx,1+ny,1+nz)
-    return ex,ey,ez,bx,by,bz
+    # --- Build the flattened mesh directly from the 1-D grid coordinates
+    x,y,z = meshgrid(xmin + arange(nx+1)*dx,
+                     ymin + arange(ny+1)*dy,
+                     zmin + arange(nz+1)*dz,indexing='ij')
+    ex,ey,ez,bx,by,bz = getappliedfields(x.ravel(),y.ravel(),z.ravel())
+    gridshape = (1+nx,1+ny,1+nz)
+    return (ex.reshape(gridshape),ey.reshape(gridshape),ez.reshape(gridshape),
+            bx.reshape(gridshape),by.reshape(gridshape),bz.reshape(gridshape))
 
 ##############################################################################
-def getappliedfields(x,y,z,time=0.,js=0):
+def getappliedfields(x,y,z,time=0.,js=0,deferlatt=False):
     """
   Gets the applied fields from the lattice at the given locations.
   It returns the tuple (ex,ey,ez,bx,by,bz)
@@ -542,17 +556,23 @@ def getappliedfields(x,y,z,time=0.,js=0):
    - time=0.: Time to use whan gathering fields - only affects time dependent
               elements.
    - js=0: species to get mass and charge from. Only affects accl elements.
+   - deferlatt=False: When true, the lattice is not reset for the simulation
+                      afterward. This is useful when making many calls in a
+                      row, but setlatt() must then be called after the last one.
+                      The internal lattice arrays are also left at the size
+                      needed here, so that they are not reallocated on each
+                      call.
     """
     try: n = len(x)
     except TypeError: n = 1
 
-    ex,ey,ez = zeros((3,n),'d')
-    bx,by,bz = zeros((3,n),'d')
+    # --- The six fields share one block of memory, each a contiguous row.
+    ex,ey,ez,bx,by,bz = zeros((6,n),'d')
 
     if n == 0: return ex,ey,ez,bx,by,bz
 
     # --- Allow z to be a scalar (as in the slice case)
-    if len(shape(z)) == 0: z = z*ones(n,'d')
+    if len(shape(z)) == 0: z = full(n,z,'d')
 
     # --- Save existing internal lattice variables so they can be restored
     # --- afterward.
@@ -581,23 +601,25 @@ def getappliedfields(x,y,z,time=0.,js=0):
         top.nzl = 1000
         top.dzl = (top.zlmax - top.zlmin)/top.nzl
         top.dzli = 1./top.dzl
-        top.nzlmax = max(top.nzlmax,top.nzl)
-        gchange("LatticeInternal")
+        # --- The internal lattice arrays are sized by nzlmax and by the
+        # --- element overlap counts (e.g. cdrftzs(0:nzlmax,ndrftol)). Of
+        # --- those, only nzlmax is changed here, so the arrays only need to
+        # --- be reallocated when it increases.
+        if top.nzl > nzlmaxsave:
+            top.nzlmax = top.nzl
+            gchange("LatticeInternal")
         zbeam = 0.
 
     # --- Make sure that the lattice is set up. If it is already, this won't
     # --- change anything (maybe).
     setlattzt(zbeam,time)
 
-    # --- Create other temporaries
-    uzp = ones(n,'d')
-    gaminv = ones(n,'d')
+    # --- Create other temporaries, all from a single allocation
+    uzp,gaminv,bendres,bendradi = ones((4,n),'d')
     dtl = -0.5*top.dt
     dtr = +0.5*top.dt
     m = top.pgroup.sm[js]
     q = top.pgroup.sq[js]
-    bendres = ones(n,'d')
-    bendradi = ones(n,'d')
     dt = top.dt
 
     exteb3d(n,x,y,z,uzp,gaminv,dtl,dtr,
@@ -611,9 +633,14 @@ def getappliedfields(x,y,z,time=0.,js=0):
     top.zlmin = zlminsave
     top.zlmax = zlmaxsave
     top.nzl = nzlsave
-    top.nzlmax = nzlmaxsave
-    gchange("LatticeInternal")
-    setlatt()
+    # --- When deferring, nzlmax is left as is so that the next call
+    # --- does not need to grow the arrays again. Having it larger than
+    # --- needed does no harm.
+    if not deferlatt:
+        if top.nzlmax != nzlmaxsave:
+            top.nzlmax = nzlmaxsave
+            gchange("LatticeInternal")
+        setlatt()
 
     return ex,ey,ez,bx,by,bz
 
@@ -688,19 +715,19 @@ def fixrestoresfrombeforeelementoverlaps(ff):
   read in, one created before the element overlaps where implemented.
   If this is the case, the lattice is reset and the overlap data generated.
     """
+    # --- For each element type, the number of elements and the array of the
+    # --- number of elements in each overlap level
+    elements = [('ndrft','odrftnn'),('nbend','obendnn'),('ndipo','odiponn'),
+                ('nquad','oquadnn'),('nsext','osextnn'),('nhele','ohelenn'),
+                ('nemlt','oemltnn'),('nmmlt','ommltnn'),('naccl','oacclnn'),
+                ('nbgrd','obgrdnn'),('npgrd','opgrdnn'),
+                ('nbsqgrad','obsqgradnn')]
     doreset = 0
-    if top.ndrft >= 0 and sum(top.odrftnn) < top.ndrft+1: doreset = 1
-    if top.nbend >= 0 and sum(top.obendnn) < top.nbend+1: doreset = 1
-    if top.ndipo >= 0 and sum(top.odiponn) < top.ndipo+1: doreset = 1
-    if top.nquad >= 0 and sum(top.oquadnn) < top.nquad+1: doreset = 1
-    if top.nsext >= 0 and sum(top.osextnn) < top.nsext+1: doreset = 1
-    if top.nhele >= 0 and sum(top.ohelenn) < top.nhele+1: doreset = 1
-    if top.nemlt >= 0 and sum(top.oemltnn) < top.nemlt+1: doreset = 1
-    if top.nmmlt >= 0 and sum(top.ommltnn) < top.nmmlt+1: doreset = 1
-    if top.naccl >= 0 and sum(top.oacclnn) < top.naccl+1: doreset = 1
-    if top.nbgrd >= 0 and sum(top.obgrdnn) < top.nbgrd+1: doreset = 1
-    if top.npgrd >= 0 and sum(top.opgrdnn) < top.npgrd+1: doreset = 1
-    if top.nbsqgrad >= 0 and sum(top.obsqgradnn) < top.nbsqgrad+1: doreset = 1
+    for nelem,onn in elements:
+        ne = getattr(top,nelem)
+        if ne >= 0 and getattr(top,onn).sum() < ne+1:
+            doreset = 1
+            break
     if doreset:
         resetlat()
         setlatt()
@@ -767,25 +794,21 @@ def fixrestoreswithmomentswithoutspecies(ff):
     top.nslabwn = top.nszmmnt
     top.nsmmnt = top.nszmmnt
     top.nshist = top.nszmmnt
-    gchange('Z_arrays')
-    gchange('Win_Moments')
-    gchange('Z_Moments')
-    gchange('Lab_Moments')
-    gchange('Moments')
-    gchange('Hist')
-    # --- Get list of variables in the file.
-    fflist = ff.inquire_names()
+    # --- The groups are all in top, so they are changed directly there,
+    # --- rather than searching through every package for each one.
+    for group in ['Z_arrays','Win_Moments','Z_Moments','Lab_Moments',
+                  'Moments','Hist']:
+        top.gchange(group)
+    # --- Get the set of variables in the file, and keep only the ones
+    # --- that are in it.
+    ffnames = frozenset(ff.inquire_names())
+    varlist1 = [v for v in varlist1 if v+'@top' in ffnames]
+    varlist = [v for v in varlist if v+'@top' in ffnames]
     # --- For each one in the file, put the data in the last element.
     for v in varlist1:
-        if v+'@top' in fflist:
-            d = ff.read(v+'@top')
-            a = getattr(top,v)
-            a[-1] = d
+        getattr(top,v)[-1] = ff.read(v+'@top')
     for v in varlist:
-        if v+'@top' in fflist:
-            d = ff.read(v+'@top')
-            a = getattr(top,v)
-            a[...,-1] = d
+        getattr(top,v)[...,-1] = ff.read(v+'@top')
 
 def fixrestoreswithoriginalparticlearrays(ff):
     # --- Check if it is an old file
@@ -798,32 +821,17 @@ def fixrestoreswithoriginalparticlearrays(ff):
     top.pgroup.ns = top.ns
     # --- Only these needs to be read in.
     #top.pgroup.ipmax_s = ff.read('npmax_s@top')
-    top.pgroup.npmax = ff.read("npmax@top")
-    top.pgroup.npid = ff.read("npid@top")
-    top.pgroup.sm = ff.read("sm@top")
-    top.pgroup.sq = ff.read("sq@top")
-    top.pgroup.sw = ff.read("sw@top")
-    top.pgroup.ins = ff.read("ins@top")
-    top.pgroup.nps = ff.read("nps@top")
-    top.pgroup.ndts = ff.read("ndts@top")
-    top.pgroup.ldts = ff.read("ldts@top")
-    top.pgroup.dtscale = ff.read("dtscale@top")
-    top.pgroup.lselfb = ff.read("lselfb@top")
-    top.pgroup.fselfb = ff.read("fselfb@top")
+    for name in ['npmax','npid','sm','sq','sw','ins','nps','ndts','ldts',
+                 'dtscale','lselfb','fselfb']:
+        setattr(top.pgroup,name,ff.read(name+'@top'))
 
     try:
         top.pgroup.sid = arange(top.ns)
     except:
         top.pgroup.js = arange(top.ns)
 
-    top.pgroup.gaminv = ff.read("gaminv@top")
-    top.pgroup.xp = ff.read("xp@top")
-    top.pgroup.yp = ff.read("yp@top")
-    top.pgroup.zp = ff.read("zp@top")
-    top.pgroup.uxp = ff.read("uxp@top")
-    top.pgroup.uyp = ff.read("uyp@top")
-    top.pgroup.uzp = ff.read("uzp@top")
-    top.pgroup.pid = ff.read("pid@top")
+    for name in ['gaminv','xp','yp','zp','uxp','uyp','uzp','pid']:
+        setattr(top.pgroup,name,ff.read(name+'@top'))
 
     ff.close()
 
@@ -834,24 +842,13 @@ def fixrestoreswitholdparticlearrays(ff):
         return
 
     top.pgroup.ns = top.ns
-    top.pgroup.npid = ff.read("npid@top")
-    top.pgroup.sm = ff.read("sm@top")
-    top.pgroup.sq = ff.read("sq@top")
-    top.pgroup.sw = ff.read("sw@top")
     top.pgroup.nps = 0
-    top.pgroup.ndts = ff.read("ndts@top")
-    top.pgroup.ldts = ff.read("ldts@top")
-    top.pgroup.dtscale = ff.read("dtscale@top")
-    top.pgroup.lselfb = ff.read("lselfb@top")
-    top.pgroup.fselfb = ff.read("fselfb@top")
-
-    gaminv = ff.read("gaminv@top")
-    xp = ff.read("xp@top")
-    yp = ff.read("yp@top")
-    zp = ff.read("zp@top")
-    uxp = ff.read("uxp@top")
-    uyp = ff.read("uyp@top")
-    uzp = ff.read("uzp@top")
+    for name in ['npid','sm','sq','sw','ndts','ldts','dtscale','lselfb','fselfb']:
+        setattr(top.pgroup,name,ff.read(name+'@top'))
+
+    gaminv,xp,yp,zp,uxp,uyp,uzp = [ff.read(name+'@top')
+                                   for name in ['gaminv','xp','yp','zp',
+                                                'uxp','uyp','uzp']]
     if top.pgroup.npid > 0:
         pid = ff.read("pid@top")
     else:
@@ -879,9 +876,8 @@ def fixrestoreswitholdparticlearrays(ff):
 
 def fixrestorewithscalarefetch(ff):
     "If the dump file has efetch as a scalar, broadcast it to the efetch array"
-    import types
     efetch = ff.read('efetch@top')
-    if isinstance(efetch,types.IntType):
+    if isinstance(efetch,(int,long,integer)):
         gchange("InPart")
         top.efetch = efetch
 
@@ -890,7 +886,9 @@ def fixrestorewithbasegridwithoutl_parallel(ff):
     if frz.getpyobject('basegrid') is None: return
 
     try:
-        # --- Then check if the basegrid in the file has the l_parallel attribute
+        # --- Then check if the basegrid in the file has the l_parallel attribute.
+        # --- This is done with a read rather than by looking in the list of
+        # --- names, since read translates the name to the form used in the file.
         ff.read('l_parallel@basegrid@frz')
     except:
         # --- if l_parallel is not found, then set it appropriately
@@ -902,8 +900,9 @@ def fixrestorewithbasegridwithoutl_parallel(ff):
                 except: g = g.down
             g.l_parallel = lparallel
 
-def fixrestorewithoutzmminlocalnzlocal(ff):
-    if 'nzlocal@w3d' not in ff.inquire_names():
+def fixrestorewithoutzmminlocalnzlocal(ff,names=None):
+    if names is None: names = frozenset(ff.inquire_names())
+    if 'nzlocal@w3d' not in names:
         w3d.nzlocal = w3d.nz
         w3d.nz = ff.read('nzfull@w3d')
         w3d.zmminlocal = w3d.zmmin
@@ -938,9 +937,11 @@ def restoreolddump(ff):
     #fixrestoreswithmomentswithoutspecies(ff)
     #fixrestoreswithoriginalparticlearrays(ff)
     #fixrestoreswitholdparticlearrays(ff)
+    # --- Get the names in the file once, for all of the checks
+    names = frozenset(ff.inquire_names())
     fixrestorewithscalarefetch(ff)
     fixrestorewithbasegridwithoutl_parallel(ff)
-    fixrestorewithoutzmminlocalnzlocal(ff)
+    fixrestorewithoutzmminlocalnzlocal(ff,names)
     pass
 
 ##############################################################################
@@ -981,32 +982,38 @@ def dump(filename=None,prefix='',suffix='',attr='dump',serial=0,pyvars=1,
     """
     import types # this is needed for ModuleType
     timetemp = wtime()
-    if not filename:
+    if ff is not None:
+        # --- The data is written into the file object that was passed in, so
+        # --- no file is opened and the filename is not needed.
+        pass
+    elif not filename:
         # --- Setup default filename based on time step and processor number.
         if serial:
             s = '.sdump'
         else:
             s = '.dump'
         if not lparallel:
-            filename=prefix+arraytostr(top.runid)+('%06d'%top.it)+suffix+s
+            filename = '%s%s%06d%s%s'%(prefix,arraytostr(top.runid),top.it,suffix,s)
         else:
-            filename=prefix+arraytostr(top.runid)+('%06d_%05d_%05d'%(top.it,me,npes))+suffix+s
+            filename = '%s%s%06d_%05d_%05d%s%s'%(prefix,arraytostr(top.runid),
+                                                 top.it,me,npes,suffix,s)
     else:
         if lparallel:
             # --- Append the processor number to the user inputted filename
             filename = filename + '_%05d_%05d%s.dump'%(me,npes,suffix)
-    print filename
+    if verbose and ff is None: print filename
     # --- Make list of all of the new python variables.
     interpreter_variables = []
     if pyvars:
         # --- Add to the list all variables which are not in the initial list
+        # --- The set lookup is done first since it excludes most names.
         for l,v in __main__.__dict__.iteritems():
+            if l in initial_global_dict_keys: continue
             if isinstance(v,types.ModuleType): continue
             if l in skip: continue
-            if l not in initial_global_dict_keys:
-                interpreter_variables.append(l)
-    # --- Resize history arrays if requested.
-    if resizeHist:
+            interpreter_variables.append(l)
+    # --- Resize history arrays if requested, only if they have unused space.
+    if resizeHist and top.lenhist != top.jhist:
         top.lenhist = top.jhist
         gchange("Hist")
     # --- Call routine to make data dump
@@ -1234,12 +1241,13 @@ def printtimers(file=None,lminmax=0,mintime=0.,icontrollers=2):
     # --- Print the subroutine timers
     def _doprint(pkg,timergroup):
         if me == 0: ff.write('\n')
-        # --- Loop over the list of timer variables (skipping the first which is
-        # --- the flag)
-        for name in pkg.varlist(timergroup)[1:]:
-            value = getattr(pkg,name)
-            vlist = array(gather(value))
-            if me > 0: continue
+        # --- Get the list of timer variables (skipping the first which is
+        # --- the flag). The values of all of them are gathered at once.
+        names = pkg.varlist(timergroup)[1:]
+        values = array([getattr(pkg,name) for name in names])
+        vlists = array(gather(values))
+        if me > 0: return
+        for name,vlist in zip(names,transpose(vlists)):
             vsum = sum(vlist)
             if vsum <= mintime: continue
             vrms = sqrt(max(0.,ave(vlist**2) - ave(vlist)**2))
@@ -1428,9 +1436,10 @@ else:
 # --- command to save interpreter variables (without saving huge amounts
 # --- of stuff that is not needed). Note that initial_global_dict_keys is
 # --- declared first as a empty list so that it itself appears in the list
-# --- of global keys.
+# --- of global keys. It is made a set since it is only used for
+# --- membership tests.
 initial_global_dict_keys = []
-initial_global_dict_keys = globals().keys()
+initial_global_dict_keys = set(globals().keys())
 
 # --- The controller function container needs to be written out since the
 # --- controllers functions may be changed by the user. The container